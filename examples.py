@@ -17,6 +17,8 @@ def simple_example():
         time.sleep(0.5)
         line.update(["Hello World!", "Everything is Awesome!"][i%2])
 
+    session.end()
+
 
 def two_lines_example():
     with coca.LinesSession() as session:
@@ -1,15 +1,85 @@
-import math
+import atexit
+import queue
 import shutil
+import signal
+import string
 import sys
 import threading
-from dataclasses import dataclass
-from typing import Optional
+from typing import Callable, Iterable, Optional, Sequence, Tuple
 
 
 # Welcome to the realm of race conditions and offset-by-one errors where
 # printing cannot be used to debug. Good luck.
 
 
+# ANSI escape codes are written to stdout as bytes. The ones for the cursor
+# moves of less than _MAX_CACHED_MOVE lines, which are by far the most common
+# ones, are built once and for all, indexed by the number of lines. Moving of
+# 0 lines means going at the beginning of the current line.
+_MAX_CACHED_MOVE = 256
+_LINE_START = b"\033[0G"
+_DOWN = [_LINE_START] + [
+    b"\033[%dE" % n for n in range(1, _MAX_CACHED_MOVE)
+]
+_UP = [_LINE_START] + [
+    b"\033[%dF" % n for n in range(1, _MAX_CACHED_MOVE)
+]
+_ERASE_LINE = b"\033[2K"
+# Go down one line and erase it
+_ERASE_STEP = _DOWN[1] + _ERASE_LINE
+
+
+def _write(data: bytes) -> None:
+    """
+    Write `data` as is to stdout. All the terminal output of coca goes through
+    here.
+    """
+    buffer = getattr(sys.stdout, 'buffer', None)
+    if buffer is not None:
+        buffer.write(data)
+    else:
+        # stdout has been replaced by a text-only stream
+        sys.stdout.write(data.decode(*_stdout_codec()))
+
+
+def _stdout_codec() -> Tuple[str, str]:
+    """
+    Return the encoding and the error handler to use to encode text the same
+    way stdout would.
+    """
+    return (
+        getattr(sys.stdout, 'encoding', None) or 'utf-8',
+        getattr(sys.stdout, 'errors', None) or 'strict',
+    )
+
+
+def _erase_lines(size: int) -> bytes:
+    """
+    Return the ANSI escape codes erasing `size` physical lines starting at the
+    cursor's one, and going back to the first of them.
+    """
+    return _ERASE_LINE + _ERASE_STEP * (size - 1) + _cursor_move(1 - size)
+
+
+def _no_erase(size: int) -> bytes:
+    return b""
+
+
+def _cursor_move(diff: int) -> bytes:
+    """
+    Return the ANSI escape code moving the cursor `diff` lines down (or up if
+    negative), at the beginning of the line.
+    """
+    if diff >= 0:
+        if diff < _MAX_CACHED_MOVE:
+            return _DOWN[diff]
+        return b"\033[%dE" % diff
+    else:
+        if -diff < _MAX_CACHED_MOVE:
+            return _UP[-diff]
+        return b"\033[%dF" % -diff
+
+
 class LinesSession:
 
     """
@@ -28,7 +98,23 @@ class LinesSession:
 
         # A dictionary of Line objects IDs to a _LineEntry object.
         self.lines_index = {}
-        self.last_line_entry = None
+
+        # The physical properties of the lines in the terminal are stored in
+        # parallel lists, indexed by the position of the line in the session
+        # (`_LineEntry.position`): the printed text and the number of
+        # physical lines of the line. Lines being printed one after the other,
+        # the physical line number of a line is the sum of the sizes of the
+        # lines before it, and is only computed when needed.
+        # On keeping the printed text in spite of it being available through
+        # Line.text():
+        # The current thread might need to rewrite lines to shift them up or
+        # down, and if another thread, in the meantime, has the Line's
+        # components updated, then the .text() method will return something
+        # different. This can lead to nasty race conditions if not handled
+        # properly. It's just simpler that any shifting will shift the current
+        # printed text.
+        self.texts = []
+        self.nb_physical_lines = []
 
         # The current physical position of the cursor on the terminal.
         # Line 0 is the first line of the program's stdout.
@@ -36,8 +122,49 @@ class LinesSession:
 
         self.printing_lock = threading.Lock()
 
+        # The printing primitives don't write to stdout directly, but
+        # accumulate their output here, which is written at once when
+        # everything there is to print is rendered (see `_render_and_write`).
+        self.output = bytearray()
+
+        # Writing to stdout is done outside of the printing lock, which is
+        # only about the state of the session, under this lock instead.
+        self.io_lock = threading.Lock()
+
+        # Line updates are queued by the updating threads and printed by a
+        # writer thread, started on the first update, so that updating a line
+        # never waits on the terminal. Queued updates are `(_LineEntry, text)`
+        # tuples, and `None` tells the writer to stop.
+        self.updates_queue = queue.Queue()
+        self.writer_thread = None
+        self.writer_lock = threading.Lock()
+        # An exception raised while printing queued updates, to be raised to
+        # the caller of the next `print_line` or `end`.
+        self.writer_error = None
+
         self.available_width = shutil.get_terminal_size()[0]
 
+        # The width is kept up to date by a SIGWINCH handler (when the
+        # platform has it, and if the session is created in the main thread,
+        # which is a requirement for signal handlers), rather than by querying
+        # the terminal size when printing. The sizes of the lines are
+        # recomputed on the next print following a resize, which is when the
+        # new width, kept pending until then, replaces the current one.
+        self.resized = False
+        self.pending_width = self.available_width
+        self.handles_sigwinch = (
+            hasattr(signal, 'SIGWINCH')
+            and threading.current_thread() is threading.main_thread()
+        )
+        if self.handles_sigwinch:
+            self.previous_sigwinch_handler = signal.signal(
+                signal.SIGWINCH, self._on_resize,
+            )
+
+        # Coca writes to the binary buffer underlying stdout, anything still
+        # pending in the text layer must go first.
+        sys.stdout.flush()
+
     def __enter__(self):
         return self
 
@@ -55,134 +182,343 @@ class LinesSession:
         separately is that you will be able to update them individually when
         updating the line with `Line.update`.
         """
-        with self.printing_lock:
-            line_obj = Line(self, template, **kwargs)
-            text = line_obj.text()
-            nb_physical_lines = self._compute_nb_physical_lines(text)
-
-            line_entry = _LineEntry(
-                line_obj=line_obj,
-                text=text,
-                line_number=self.lines_counter - 1,
-                nb_physical_lines=nb_physical_lines,
-                next_line_entry=None,
-            )
-            self.lines_index[id(line_obj)] = line_entry
-            if self.last_line_entry is not None:
-                self.last_line_entry.next_line_entry = line_entry
-            self.last_line_entry = line_entry
-
-            # It seems that writing a line that is too big to fit into the
-            # current available vertical space will make it shift upwards for
-            # some reason. For this reason we "reserve" the vertical space
-            # we're gonna need by printing some empty lines at the end.
-            self._extend(nb_physical_lines - 1)
-            self._print_at_line(text, line_entry.line_number)
-
+        line_obj = Line(self, template, **kwargs)
+        self._render_and_write(self._add_line, line_obj)
         return line_obj
 
+    def _add_line(self, line_obj: 'Line') -> None:
+        """
+        Print a new Line at the end of the session. Requires the printing
+        lock.
+        """
+        if self.resized:
+            self._apply_resize()
+
+        text = line_obj.text()
+        # Fail before touching the session if the text cannot be written to
+        # stdout.
+        text.encode(*_stdout_codec())
+        nb_physical_lines = self._compute_nb_physical_lines(text)
+
+        line_number = self.lines_counter - 1
+        self.lines_index[id(line_obj)] = _LineEntry(
+            line_obj=line_obj,
+            position=len(self.texts),
+        )
+        self.texts.append(text)
+        self.nb_physical_lines.append(nb_physical_lines)
+
+        # It seems that writing a line that is too big to fit into the
+        # current available vertical space will make it shift upwards for
+        # some reason. For this reason we "reserve" the vertical space
+        # we're gonna need by printing some empty lines at the end.
+        self._extend(nb_physical_lines)
+        self._print_at_line(text, line_number, nb_physical_lines)
+
     def print_line(self, line_obj: 'Line') -> None:
         """
         Given a Line object assumed to be associated with the session, update
         stdout with the current text rendering of the Line.
         """
-        with self.printing_lock:
-            line_entry = self.lines_index[id(line_obj)]
+        self._raise_writer_error()
+        line_entry = self.lines_index[id(line_obj)]
+        if self.writer_thread is None:
+            self._start_writer()
+
+        # Rendering the text only concerns this line, so it's
+        # done under the line's own lock rather than the session-wide one,
+        # which other threads updating other lines don't have to wait for.
+        # The line's lock is held until the update is queued so that
+        # concurrent updates of the same line are printed in order.
+        with line_entry.lock:
             text = line_obj.text()
-            line_entry.text = text
-
-            old_nb_physical_lines = line_entry.nb_physical_lines
-            new_nb_physical_lines = self._compute_nb_physical_lines(text)
-
+            # Fail here rather than in the writer thread if the text cannot
+            # be written to stdout.
+            text.encode(*_stdout_codec())
+            self.updates_queue.put((line_entry, text))
+
+    def _print_line_entries(
+        self,
+        updates: Iterable[Tuple['_LineEntry', str]],
+    ) -> None:
+        for line_entry, text in updates:
+            self._print_line_entry(line_entry, text)
+
+    def _print_line_entry(
+        self,
+        line_entry: '_LineEntry',
+        text: str,
+    ) -> None:
+        """
+        Print the new `text` of an existing line, shifting the following lines
+        if its number of physical lines changed. Requires the printing lock.
+        """
+        if self.resized:
+            self._apply_resize()
+
+        new_nb_physical_lines = self._compute_nb_physical_lines(text)
+        position = line_entry.position
+        texts = self.texts
+        sizes = self.nb_physical_lines
+        old_text = texts[position]
+        texts[position] = text
+        line_number = sum(sizes[:position])
+
+        old_nb_physical_lines = sizes[position]
+
+        if old_nb_physical_lines == new_nb_physical_lines:
+            # When the new text is at least as long as the old one, it is
+            # simply written over it, without erasing it first. This is only
+            # done when each character of both texts is known to take exactly
+            # one unit of width, which excludes wide characters, combining
+            # marks, tabs, escape codes and the likes.
+            covers_old_text = (
+                len(text) >= len(old_text)
+                and old_text.isascii()
+                and text.isascii()
+                and old_text.isprintable()
+                and text.isprintable()
+            )
+            self._print_at_line(
+                text, line_number, new_nb_physical_lines,
+                erase=not covers_old_text,
+            )
+        else:
             if old_nb_physical_lines < new_nb_physical_lines:
                 size_diff = new_nb_physical_lines - old_nb_physical_lines
                 self._extend(size_diff)
 
-            self._print_at_line(text, line_entry.line_number)
-
-            if old_nb_physical_lines != new_nb_physical_lines:
-                line_entry.nb_physical_lines = new_nb_physical_lines
-
-                # The new text has fewer or more physical lines than the existing
-                # one, we must rewrite all the following lines which will be shifted
-                # either up or down.
-                current_line_entry = line_entry.next_line_entry
-                current_line_number = line_entry.line_number + new_nb_physical_lines
-                while current_line_entry is not None:
-                    current_line_entry.line_number = current_line_number
-                    self._print_at_line(
-                        current_line_entry.text,
-                        current_line_number,
-                    )
-                    current_line_number += current_line_entry.nb_physical_lines
-                    current_line_entry = current_line_entry.next_line_entry
-
-            if new_nb_physical_lines < old_nb_physical_lines:
-                # Lines have been shifted up, this means that there is a
-                # remnent of previous lines prints at the end of stdout, which
-                # we need to clear up.
-                self._truncate()
+            sizes[position] = new_nb_physical_lines
+
+            # The new text has fewer or more physical lines than the existing
+            # one, we must rewrite all the following lines which will be
+            # shifted either up or down. They are printed along with the line
+            # itself in a single block.
+            self._print_lines_at_line(
+                texts[position:], sizes[position:], line_number,
+            )
+
+        if new_nb_physical_lines < old_nb_physical_lines:
+            # Lines have been shifted up, this means that there is a
+            # remnent of previous lines prints at the end of stdout, exactly
+            # as big as the shift, which we need to clear up.
+            size_diff = old_nb_physical_lines - new_nb_physical_lines
+            self._truncate(self.lines_counter - 1 - size_diff, size_diff)
 
     def end(self) -> None:
         """
         Put the cursor at the end this session stdout.
         """
-        self._set_cursor_to_line_number(self.lines_counter - 1)
-
-    def _compute_nb_physical_lines(self, text: str) -> int:
-        return max(1, math.ceil(len(text) / self.available_width))
-
-    def _print_at_line(self, text: str, line_number: int) -> None:
+        self._stop_writer()
+        self._raise_writer_error()
+        self._render_and_write(self._set_cursor_to_end)
+
+        # The previous handler is only restored if ours is still the one
+        # installed, a session started after this one may have replaced it.
+        if (
+            self.handles_sigwinch
+            and threading.current_thread() is threading.main_thread()
+        ):
+            if signal.getsignal(signal.SIGWINCH) == self._on_resize:
+                signal.signal(
+                    signal.SIGWINCH,
+                    self.previous_sigwinch_handler or signal.SIG_DFL,
+                )
+            self.handles_sigwinch = False
+
+    def _on_resize(self, signum, frame) -> None:
+        # Being a signal handler, this can run in the middle of anything in
+        # the main thread, including while it holds the printing lock, so it
+        # only flags the resize.
+        self.pending_width = shutil.get_terminal_size()[0]
+        self.resized = True
+        if callable(self.previous_sigwinch_handler):
+            self.previous_sigwinch_handler(signum, frame)
+
+    def _apply_resize(self) -> None:
         """
-        Print `text` at the given physical `line_number`.
+        Recompute the number of physical lines of all the lines after a resize
+        of the terminal. Requires the printing lock.
         """
-        size = self._compute_nb_physical_lines(text)
-
-        # Erase the current content of the physical lines, if any
-        for position in range(line_number, line_number + size):
-            self._set_cursor_to_line_number(position)
-            print("\033[2K", end='')
+        self.resized = False
+        self.available_width = self.pending_width
+        cursor_at_end = self.current_line == self.lines_counter - 1
+        self.nb_physical_lines = [
+            self._compute_nb_physical_lines(text) for text in self.texts
+        ]
+        self.lines_counter = sum(self.nb_physical_lines) + 1
+        if cursor_at_end:
+            self.current_line = self.lines_counter - 1
+
+    def _start_writer(self) -> None:
+        with self.writer_lock:
+            if self.writer_thread is not None:
+                return
+            self.writer_thread = threading.Thread(
+                target=self._write_updates, daemon=True,
+            )
+            self.writer_thread.start()
+            # The writer being a daemon thread, make sure pending updates are
+            # printed if the program exits without ending the session.
+            atexit.register(self._stop_writer)
 
-        # Print the new content
-        self._set_cursor_to_line_number(line_number)
-        print(text)
+    def _stop_writer(self) -> None:
+        """
+        Wait for all the queued updates to be printed and stop the writer
+        thread, if any.
+        """
+        with self.writer_lock:
+            if self.writer_thread is None:
+                return
+            self.updates_queue.put(None)
+            self.writer_thread.join()
+            self.writer_thread = None
+            atexit.unregister(self._stop_writer)
+
+    def _write_updates(self) -> None:
+        """
+        Writer thread loop, printing the queued updates.
+        """
+        get = self.updates_queue.get
+        get_nowait = self.updates_queue.get_nowait
+
+        stop = False
+        while not stop:
+            # Take everything that is already waiting in the queue, so that a
+            # burst of updates is printed in one go, and only the last text of
+            # a line updated several times in the meantime is printed.
+            updates = [get()]
+            while True:
+                try:
+                    updates.append(get_nowait())
+                except queue.Empty:
+                    break
+
+            latest_updates = {}
+            for update in updates:
+                if update is None:
+                    stop = True
+                else:
+                    latest_updates[update[0].position] = update
+
+            # The writer must survive a failing batch, otherwise all the
+            # following updates would be queued and never printed. The error
+            # is raised to the updating threads instead.
+            try:
+                self._render_and_write(
+                    self._print_line_entries, latest_updates.values(),
+                )
+            except Exception as error:
+                self.writer_error = error
+
+    def _raise_writer_error(self) -> None:
+        error = self.writer_error
+        if error is not None:
+            self.writer_error = None
+            raise error
 
-        self.current_line = line_number + size
+    def _compute_nb_physical_lines(self, text: str) -> int:
+        # Ceiling of the division, using integers only
+        length = len(text)
+        return 1 if length == 0 else -(-length // self.available_width)
+
+    def _print_at_line(
+        self,
+        text: str,
+        line_number: int,
+        size: int,
+        erase: bool = True,
+    ) -> None:
+        """
+        Print `text` at the given physical `line_number`. `size` is the number
+        of physical lines of `text`, which callers always know already.
+        """
+        self._print_lines_at_line((text,), (size,), line_number, erase)
+
+    def _print_lines_at_line(
+        self,
+        texts: Sequence[str],
+        sizes: Sequence[int],
+        line_number: int,
+        erase: bool = True,
+    ) -> None:
+        """
+        Print consecutive lines of text starting at the given physical
+        `line_number`, `sizes` giving the number of physical lines of each
+        text. If `erase` is False, the texts are written over the current
+        content of the physical lines, which they must entirely cover.
+        """
+        # For each line, erase the current content of its physical lines, if
+        # any, go back to the first one and print the new content, which
+        # leaves the cursor at the beginning of the next line.
+        output = self.output
+        output += _cursor_move(line_number - self.current_line)
+        erase_lines = _erase_lines if erase else _no_erase
+        encoding, errors = _stdout_codec()
+        for text, size in zip(texts, sizes):
+            output += erase_lines(size)
+            output += (text + "\n").encode(encoding, errors)
+
+        self.current_line = line_number + sum(sizes)
         self.lines_counter = max(self.lines_counter, self.current_line + 1)
 
     def _set_cursor_to_line_number(self, line_number: int):
         # ANSI Escape codes are used to move the cursor
         # (https://gist.github.com/fnky/458719343aabd01cfb17a3a4f7296797)
-        diff = line_number - self.current_line
-        if diff == 0:
-            # Only go at the beginning of the current line
-            print('\033[0G', end='')
-        else:
-            print(f"\033[{abs(diff)}{'E' if diff > 0 else 'F'}", end='')
-        sys.stdout.flush()
+        self.output += _cursor_move(line_number - self.current_line)
         self.current_line = line_number
 
+    def _set_cursor_to_end(self) -> None:
+        self._set_cursor_to_line_number(self.lines_counter - 1)
+
     def _extend(self, size):
         """
         Extend the number of lines of the current session by `size` lines, by
         printing enough empty lines at the end of what is already printed.
         """
-        for line_number in range(
-            self.lines_counter - 1, self.lines_counter + size
-        ):
-            self._print_at_line('', line_number)
+        self._print_lines_at_line(
+            ('',) * size, (1,) * size, self.lines_counter - 1,
+        )
+
+    def _truncate(self, line_number: int, size: int) -> None:
+        """
+        Remove the last `size` physical lines of the session, starting at
+        `line_number`, and leave the cursor at `line_number`, which becomes the
+        end of the session.
+        """
+        self.output += (
+            _cursor_move(line_number - self.current_line) + _erase_lines(size)
+        )
+        self.current_line = line_number
+        self.lines_counter -= size
 
-    def _truncate(self):
+    def _render_and_write(self, render: Callable[..., None], *args) -> None:
         """
-        Remove everything starting from the current cursor position, and restore
-        the cursor to its position at the moment this method is called.
+        Call `render(*args)`, which prints using the printing primitives,
+        under the printing lock, then write all its output to stdout at once,
+        after releasing the printing lock.
         """
-        original_cursor_position = self.current_line
-        size_truncation = self.lines_counter - self.current_line - 1
-        for line_number in range(self.current_line, self.lines_counter - 1):
-            self._print_at_line('', line_number)
-        self._set_cursor_to_line_number(original_cursor_position)
-        self.lines_counter -= size_truncation
+        with self.printing_lock:
+            try:
+                render(*args)
+            except BaseException:
+                # Don't write a partial rendering with the next output
+                self.output.clear()
+                raise
+            output = bytes(self.output)
+            self.output.clear()
+            # The I/O lock is taken before the printing lock is released, so
+            # that outputs are written in the order they have been rendered.
+            self.io_lock.acquire()
+        try:
+            if output:
+                _write(output)
+                sys.stdout.flush()
+        finally:
+            self.io_lock.release()
+
+
+_formatter = string.Formatter()
 
 
 class Line:
@@ -194,16 +530,30 @@ class Line:
 
     def __init__(self, session: LinesSession, template: str, **kwargs):
         self.session = session
-        self.template = template
         self.kwargs = kwargs
+        self._set_template(template)
 
     def text(self) -> str:
         """
         Return the current text rendering of this line.
         """
-        if not self.kwargs:
+        if self._is_literal:
             return self.template
-        return self.template.format(**self.kwargs)
+        kwargs = self.kwargs
+        if not kwargs:
+            return self.template
+        if not self._has_fields:
+            return self._literal_text
+        plan = self._plan
+        if plan is None:
+            return self.template.format(**kwargs)
+
+        parts = []
+        for literal, field_name, format_spec in plan:
+            parts.append(literal)
+            if field_name is not None:
+                parts.append(format(kwargs[field_name], format_spec))
+        return "".join(parts)
 
     def update(self, template: Optional[str] = None, **kwargs) -> None:
         """
@@ -212,29 +562,63 @@ class Line:
         can be updated with keyword arguments.
         """
         if template is not None:
-            self.template = template
+            self._set_template(template)
             self.kwargs = {}
         self.kwargs.update(kwargs)
         self.session.print_line(self)
 
+    def _set_template(self, template: str) -> None:
+        # The template is parsed once here rather than by `str.format` on
+        # every rendering. Only plain `{name}` / `{name:spec}` fields are
+        # handled by the plan, anything fancier (attribute access, indexing,
+        # conversions, nested specs) falls back to `str.format`.
+        # Malformed templates (a stray brace) also fall back to `str.format`,
+        # so that, as before, they are printed as is without keyword
+        # arguments and only raise when formatted with some.
+        plan = []
+        has_fields = fallback = False
+        try:
+            for literal, field_name, format_spec, conversion in (
+                _formatter.parse(template)
+            ):
+                if field_name is not None:
+                    has_fields = True
+                    if (
+                        not field_name.isidentifier()
+                        or conversion is not None
+                        or '{' in (format_spec or '')
+                    ):
+                        fallback = True
+                        break
+                plan.append((literal, field_name, format_spec))
+        except ValueError:
+            has_fields = fallback = True
+        literal_text = template if has_fields else "".join(
+            literal for literal, _, _ in plan
+        )
+
+        self.template = template
+        # Templates without any curly brace, most of them, don't even need
+        # the plan.
+        self._is_literal = '{' not in template and '}' not in template
+        self._plan: Optional[list] = None if fallback else plan
+        self._has_fields = has_fields
+        self._literal_text = literal_text
+
 
-@dataclass
 class _LineEntry:
 
     """
-    Internal linked list of all the Line objects known by the session,
-    additionally containing the physical properties of the line in the terminal
-    (position, size, and the text itself).
+    Internal handle of a Line object known by the session, giving the position
+    of the line in the session, whose physical properties in the terminal are
+    stored by the session (`LinesSession.texts` and the likes).
     """
-    line_obj: Line
-    # On the LineEntry keeping its current text in spite of the text being available
-    # through Line.text():
-    # The current thread might need to rewrite lines to shift them up or down,
-    # and if another thread, in the meantime, has the Line's components
-    # updated, then the .text() method will return something different. This
-    # can lead to nasty race conditions if not handled properly. It's just
-    # simpler that any shifting will shift the current printed text.
-    text: str
-    line_number: int
-    nb_physical_lines: int
-    next_line_entry: Optional['_LineEntry']
+
+    __slots__ = ('line_obj', 'position', 'lock')
+
+    def __init__(self, line_obj: Line, position: int):
+        self.line_obj = line_obj
+        self.position = position
+        # Serializes the updates of this line only, see
+        # `LinesSession.print_line`
+        self.lock = threading.Lock()
@@ -0,0 +1,41 @@
+import pytest
+
+import coca
+
+
+@pytest.mark.parametrize('template, kwargs', [
+    ("Hello World!", {}),
+    ("Hello World!", {'unused': 1}),
+    ("Escaped {{braces}}", {'unused': 1}),
+    ("Progress: [{percent:.2f}%] {bar}>", {'percent': 12.5, 'bar': '==='}),
+    ("[Thread {thread}]: {count}", {'thread': 3, 'count': 42}),
+    ("{value!r} {value.real} {items[0]}", {'value': 1, 'items': ['a']}),
+    ("{value:{width}}|", {'value': 'x', 'width': 5}),
+])
+def test_text_matches_str_format(mocker, template, kwargs):
+    session = mocker.Mock()
+    line = coca.Line(session, template, **kwargs)
+
+    assert line.text() == template.format(**kwargs)
+
+
+def test_text_after_template_update(mocker):
+    session = mocker.Mock()
+    line = coca.Line(session, "{a}", a=1)
+
+    line.update("{b}-{b}", b=2)
+
+    assert line.text() == "2-2"
+    session.print_line.assert_called_with(line)
+
+
+def test_malformed_template_is_printed_as_is(mocker):
+    session = mocker.Mock()
+    line = coca.Line(session, "v={v}", v=1)
+
+    line.update("{")
+    assert line.text() == "{"
+
+    line.update(v=2)
+    with pytest.raises(ValueError):
+        line.text()
@@ -9,53 +9,51 @@ for the behavior they achieve.
 """
 
 import re
+import signal
 
 import pytest
 
 import coca
 
 
-def _sum_jumps(print_calls, ansi_codes_only=False):
+@pytest.fixture(autouse=True)
+def restore_sigwinch_handler():
     """
-    From a list of mock calls to the print function, return the net result
-    of cursor moves. A negative number means "up" and a positive one "down".
+    Most sessions of the tests are never ended, their SIGWINCH handlers must
+    not outlive the test.
     """
-    net = 0
-    for _, args, kwargs in print_calls:
-        text = args[0]
-
-        if not ansi_codes_only:
-            net += text.count('\n')
-            net += kwargs.get('end', '\n').count('\n')
-
-        if match := re.match('\033\[([0-9]+)(E|F)', text):
-            diff, direction = match.groups()
-            net += int(diff) * (-1 if direction == 'F' else 1)
-
-    return net
+    if not hasattr(signal, 'SIGWINCH'):
+        yield
+        return
+    handler = signal.getsignal(signal.SIGWINCH)
+    yield
+    signal.signal(signal.SIGWINCH, handler)
 
 
-def _text_index(print_calls, text):
+def _output(write_mock):
     """
-    From a list of mock calls to the print function, return the index of the
-    given printed `text`, or None if no such text is found.
+    From a mock of the `coca._write` function, return everything that has been
+    written to stdout, as a single string.
     """
-    for i, (_, pos_args, _) in enumerate(print_calls):
-        if pos_args[0] == text:
-            return i
-    return None
+    return b''.join(
+        args[0] for _, args, _ in write_mock.mock_calls
+    ).decode()
 
 
-def _count_text(print_calls, text):
+def _sum_jumps(output, ansi_codes_only=False):
     """
-    From a list of mock calls to the print function, return the number of times
-    `text` has been printed.
+    From the output written to stdout, return the net result of cursor moves.
+    A negative number means "up" and a positive one "down".
     """
-    count = 0
-    for _, pos_args, _ in print_calls:
-        if pos_args[0] == text:
-            count += 1
-    return count
+    net = 0
+
+    if not ansi_codes_only:
+        net += output.count('\n')
+
+    for diff, direction in re.findall('\033\\[([0-9]+)(E|F)', output):
+        net += int(diff) * (-1 if direction == 'F' else 1)
+
+    return net
 
 
 @pytest.mark.parametrize('line_to_print_to, expected_net_jump', [
@@ -69,17 +67,19 @@ def test_print_at_line(mocker, line_to_print_to, expected_net_jump):
     session.current_line = 7
     session.available_width = 80
 
-    print_mock = mocker.patch('coca.print')
+    write_mock = mocker.patch('coca._write')
 
-    session._print_at_line("hello world", line_to_print_to)
+    session._render_and_write(
+        session._print_at_line, "hello world", line_to_print_to, 1,
+    )
 
-    print_calls = print_mock.mock_calls
-    erased_code_index = _text_index(print_calls, '\033[2K')
-    hello_index = _text_index(print_calls, "hello world")
+    output = _output(write_mock)
+    erased_code_index = output.find('\033[2K')
+    hello_index = output.find("hello world")
 
-    assert _sum_jumps(print_calls, ansi_codes_only=True) == expected_net_jump
-    assert erased_code_index is not None
-    assert hello_index is not None
+    assert _sum_jumps(output, ansi_codes_only=True) == expected_net_jump
+    assert erased_code_index != -1
+    assert hello_index != -1
     assert erased_code_index < hello_index
 
     assert session.current_line == line_to_print_to + 1
@@ -92,30 +92,205 @@ def test_print_multiple_lines_at_line(mocker):
     session.current_line = 2
     session.available_width = 80
 
-    mocker.patch('coca.print')
+    write_mock = mocker.patch('coca._write')
 
-    session._print_at_line('a'*150, 2)
+    session._render_and_write(session._print_at_line, 'a'*150, 2, 2)
+
+    # Both physical lines are erased, with a single write
+    assert write_mock.call_count == 1
+    assert _output(write_mock).count('\033[2K') == 2
 
     assert session.lines_counter == 10
     assert session.current_line == 4
 
 
+def test_extend(mocker):
+    session = coca.LinesSession()
+    session.lines_counter = 10
+    session.current_line = 7
+    session.available_width = 80
+
+    write_mock = mocker.patch('coca._write')
+
+    session._render_and_write(session._extend, 2)
+
+    # The last line (always empty) and a new one have been erased
+    assert _output(write_mock).count('\033[2K') == 2
+
+    assert session.current_line == 11
+    assert session.lines_counter == 12
+
+
 def test_truncate(mocker):
     session = coca.LinesSession()
     session.lines_counter = 10
     session.current_line = 7
     session.available_width = 80
 
-    print_mock = mocker.patch('coca.print')
+    write_mock = mocker.patch('coca._write')
 
-    session._truncate()
+    session._render_and_write(session._truncate, 7, 2)
 
-    print_calls = print_mock.mock_calls
+    output = _output(write_mock)
 
     # We removed 2 lines (last line is always empty)
-    assert _count_text(print_calls, '\033[2K') == 2
+    assert output.count('\033[2K') == 2
     # The cursor did not move
-    assert _sum_jumps(print_calls) == 0
+    assert _sum_jumps(output) == 0
 
     assert session.current_line == 7
     assert session.lines_counter == 8
+
+
+def test_queued_updates_are_coalesced(mocker):
+    session = coca.LinesSession()
+    session.available_width = 80
+
+    mocker.patch('coca._write')
+    line = session.line("count: {count}", count=0)
+
+    # Pretend the writer thread is already running so that the updates pile
+    # up in the queue
+    session.writer_thread = mocker.Mock()
+    for count in range(1, 6):
+        line.update(count=count)
+    session.writer_thread = None
+
+    print_line_entry = mocker.spy(session, '_print_line_entry')
+    session._start_writer()
+    session.end()
+
+    print_line_entry.assert_called_once()
+    _, text = print_line_entry.call_args[0]
+    assert text == "count: 5"
+    assert session.writer_thread is None
+
+
+def test_resize(mocker):
+    session = coca.LinesSession()
+    session.available_width = 80
+
+    mocker.patch('coca._write')
+    session.line('a'*150)
+    assert session.nb_physical_lines == [2]
+    assert session.lines_counter == 3
+
+    mocker.patch('shutil.get_terminal_size', return_value=(40, 24))
+    session._on_resize(None, None)
+    # The new width is only used from the next print on
+    assert session.available_width == 80
+    session.line('b')
+
+    assert session.available_width == 40
+    assert session.nb_physical_lines == [4, 1]
+    assert session.lines_counter == 6
+
+    session.end()
+
+
+@pytest.mark.skipif(
+    not hasattr(signal, 'SIGWINCH'), reason="Platform without SIGWINCH",
+)
+def test_sigwinch_handler_restoration(mocker):
+    mocker.patch('coca._write')
+
+    session_a = coca.LinesSession()
+    session_b = coca.LinesSession()
+    assert signal.getsignal(signal.SIGWINCH) == session_b._on_resize
+
+    # Ending A first must not uninstall B's handler
+    session_a.end()
+    assert signal.getsignal(signal.SIGWINCH) == session_b._on_resize
+
+    # B restores the handler it replaced
+    session_b.end()
+    assert signal.getsignal(signal.SIGWINCH) == session_a._on_resize
+
+
+@pytest.mark.parametrize('old_text, new_text, expected_erase', [
+    ("count: 9", "count: 10", False),
+    ("count: 10", "count: 10", False),
+    ("count: 10", "count: 9", True),
+    ("💖💖💖💖💖💖", "Everything is Awesome", True),
+    ("Everything", "\033[1mEverything\033[0m", True),
+    # NFD form: the combining accents take no width
+    ("file: resume.txt", "file: re\u0301sume\u0301.md", True),
+])
+def test_print_line_entry_erase(
+    mocker, old_text, new_text, expected_erase,
+):
+    session = coca.LinesSession()
+    session.available_width = 80
+
+    write_mock = mocker.patch('coca._write')
+    session.line(old_text)
+    write_mock.reset_mock()
+
+    line_entry, = session.lines_index.values()
+    session._render_and_write(
+        session._print_line_entry, line_entry, new_text,
+    )
+
+    output = _output(write_mock)
+    assert ('\033[2K' in output) == expected_erase
+    assert new_text in output
+
+
+def test_writer_error_is_raised_to_caller(mocker):
+    session = coca.LinesSession()
+    session.available_width = 80
+
+    write_mock = mocker.patch('coca._write')
+    line = session.line("v={v}", v=1)
+
+    write_mock.side_effect = BrokenPipeError
+    line.update(v=2)
+    session._stop_writer()
+
+    # The writer thread survived the error, which is raised to the caller
+    with pytest.raises(BrokenPipeError):
+        line.update(v=3)
+
+    write_mock.side_effect = None
+    write_mock.reset_mock()
+    line.update(v=4)
+    session.end()
+
+    assert "v=4" in _output(write_mock)
+
+
+def test_unencodable_update_is_raised_to_caller(mocker):
+    session = coca.LinesSession()
+    session.available_width = 80
+
+    write_mock = mocker.patch('coca._write')
+    mocker.patch('coca._stdout_codec', return_value=('ascii', 'strict'))
+    line = session.line("v={v}", v=1)
+
+    with pytest.raises(UnicodeEncodeError):
+        line.update(v="é")
+    with pytest.raises(UnicodeEncodeError):
+        session.line("é")
+    assert session.texts == ["v=1"]
+
+    line.update(v=2)
+    session.end()
+
+    assert "v=2" in _output(write_mock)
+
+
+def test_interrupted_write_releases_io_lock(mocker):
+    session = coca.LinesSession()
+    session.available_width = 80
+
+    write_mock = mocker.patch('coca._write', side_effect=KeyboardInterrupt)
+    with pytest.raises(KeyboardInterrupt):
+        session.line("Hello World!")
+
+    assert not session.io_lock.locked()
+    assert not session.printing_lock.locked()
+
+    write_mock.side_effect = None
+    write_mock.reset_mock()
+    session.end()
+    write_mock.assert_called_once()